@@ -0,0 +1,129 @@
+"""Benchmark the image relay against a local stand-in image server.
+
+Reports time to first byte and total time for:
+  direct      fetching straight from the stand-in server
+  cold        relay misses (a fresh upstream URL each time)
+  warm        relay hits served from the disk cache
+  coalesced   N clients asking for the same fresh URL at once
+  revalidate  If-None-Match on a cached image (304)
+
+    python bench_image_relay.py --size 524288 --chunks 16 --delay 0.01 --clients 20
+"""
+import time
+import asyncio
+import argparse
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import httpx
+import uvicorn
+from fastapi import FastAPI, Request
+from image_relay import ImageRelay
+
+class StandIn:
+    """Serves a fixed payload as image/jpeg, dribbled out in chunks"""
+
+    def __init__(self, size: int, chunks: int, delay: float):
+        self.payload = b'\xff' * size
+        self.chunks = chunks
+        self.delay = delay
+        self.hits = 0
+        stand_in = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                stand_in.hits += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(stand_in.payload)))
+                self.end_headers()
+                step = -(-len(stand_in.payload) // stand_in.chunks)
+                for offset in range(0, len(stand_in.payload), step):
+                    time.sleep(stand_in.delay)
+                    self.wfile.write(stand_in.payload[offset:offset + step])
+                    self.wfile.flush()
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f"http://127.0.0.1:{self.server.server_address[1]}/image.jpg"
+        threading.Thread(target=self.server.serve_forever, daemon=True).start()
+
+def start_relay(relay: ImageRelay) -> tuple:
+    app = FastAPI()
+
+    @app.get("/api/image/{image_id}")
+    async def image(image_id: str, request: Request):
+        return await relay.respond(image_id, request.headers)
+
+    server = uvicorn.Server(uvicorn.Config(app, host='127.0.0.1', port=0, log_level='warning'))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    while not server.started:
+        time.sleep(0.01)
+    port = server.servers[0].sockets[0].getsockname()[1]
+    return server, thread, f"http://127.0.0.1:{port}"
+
+async def timed_get(client: httpx.AsyncClient, url: str, headers: dict = None) -> tuple:
+    started = time.perf_counter()
+    first_byte = None
+    async with client.stream('GET', url, headers=headers) as response:
+        async for _ in response.aiter_bytes():
+            if first_byte is None:
+                first_byte = time.perf_counter() - started
+        total = time.perf_counter() - started
+        return response.status_code, first_byte if first_byte is not None else total, total, response.headers.get('etag')
+
+def percentile(samples: list, fraction: float) -> float:
+    ordered = sorted(samples)
+    return ordered[min(int(len(ordered) * fraction), len(ordered) - 1)]
+
+def report(name: str, results: list, note: str = ''):
+    ttfb = [result[1] * 1000 for result in results]
+    total = [result[2] * 1000 for result in results]
+    print(f"{name:<11} {len(results):>4} {percentile(ttfb, 0.5):>10.1f} {percentile(ttfb, 0.95):>10.1f} "
+          f"{percentile(total, 0.5):>10.1f} {percentile(total, 0.95):>10.1f}  {note}")
+
+async def bench(args, stand_in: StandIn, relay: ImageRelay, base_url: str):
+    def relayed(n):
+        return base_url + relay.relay_url(f"{stand_in.url}?n={n}")
+
+    print(f"{'case':<11} {'reqs':>4} {'ttfb p50':>10} {'ttfb p95':>10} {'total p50':>10} {'total p95':>10}  (ms)")
+    async with httpx.AsyncClient(timeout=60) as client:
+        report('direct', [await timed_get(client, stand_in.url) for _ in range(args.requests)])
+
+        report('cold', [await timed_get(client, relayed(n)) for n in range(args.requests)])
+
+        report('warm', [await timed_get(client, relayed(0)) for _ in range(args.requests)])
+
+        hits = stand_in.hits
+        results = await asyncio.gather(*(timed_get(client, relayed('coalesced')) for _ in range(args.clients)))
+        report('coalesced', results, f"{stand_in.hits - hits} upstream fetch(es) for {args.clients} clients")
+
+        etag = (await timed_get(client, relayed(0)))[3]
+        results = [await timed_get(client, relayed(0), {'If-None-Match': etag}) for _ in range(args.requests)]
+        report('revalidate', results, f"status {results[0][0]}")
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--size', type=int, default=512 * 1024, help="image size in bytes")
+    parser.add_argument('--chunks', type=int, default=16, help="chunks the stand-in sends the image in")
+    parser.add_argument('--delay', type=float, default=0.01, help="seconds the stand-in waits before each chunk")
+    parser.add_argument('--requests', type=int, default=20, help="sequential requests per case")
+    parser.add_argument('--clients', type=int, default=20, help="concurrent clients in the coalesced case")
+    args = parser.parse_args()
+
+    stand_in = StandIn(args.size, args.chunks, args.delay)
+    with tempfile.TemporaryDirectory() as cache_dir:
+        relay = ImageRelay(cache_dir=cache_dir)
+        server, thread, base_url = start_relay(relay)
+        try:
+            asyncio.run(bench(args, stand_in, relay, base_url))
+        finally:
+            server.should_exit = True
+            thread.join()
+            stand_in.server.shutdown()
+
+if __name__ == "__main__":
+    main()
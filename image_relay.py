@@ -0,0 +1,348 @@
+import os
+import re
+import json
+import hmac
+import uuid
+import base64
+import asyncio
+import hashlib
+import secrets
+import time
+import httpx
+from collections import OrderedDict
+from fastapi import HTTPException
+from fastapi.responses import Response, StreamingResponse
+from http_client import get_http_client
+
+IMAGE_CACHE_DIR = os.environ.get('IMAGE_CACHE_DIR', '/tmp/savetubex-images')
+IMAGE_CACHE_MAX_BYTES = int(os.environ.get('IMAGE_CACHE_MAX_BYTES', 256 * 1024 * 1024))
+IMAGE_MAX_BYTES = 10 * 1024 * 1024
+IMAGE_FETCH_TIMEOUT = 30
+# Must be shared by every worker and survive restarts, or relay links stop verifying
+RELAY_SECRET = os.environ.get('RELAY_SECRET', '').encode() or secrets.token_bytes(32)
+RELAY_PATH = '/api/image/'
+CACHE_CONTROL = 'public, max-age=31536000, immutable'
+CHUNK_SIZE = 64 * 1024
+
+_ID_RE = re.compile(r'^([A-Za-z0-9_-]+)\.([0-9a-f]{32})$')
+_RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+
+def _sign(url: str) -> str:
+    return hmac.new(RELAY_SECRET, url.encode(), hashlib.sha256).hexdigest()[:32]
+
+def etag_matches(if_none_match: str, etag: str) -> bool:
+    """Weak comparison as If-None-Match requires; CDNs often rewrite ETags to W/"..." """
+    if not if_none_match:
+        return False
+    tags = [tag.strip().removeprefix('W/') for tag in if_none_match.split(',')]
+    return '*' in tags or etag.removeprefix('W/') in tags
+
+def absolute_urls(result: dict, base_url: str) -> dict:
+    """Prefix the relay paths in a parse result with the public base URL"""
+    def absolute(url):
+        return f"{base_url}{url}" if url.startswith(RELAY_PATH) else url
+
+    result = dict(result)
+    if 'thumbnail' in result:
+        result['thumbnail'] = absolute(result['thumbnail'])
+    if 'images' in result:
+        result['images'] = [{**image, 'url': absolute(image['url'])} for image in result['images']]
+    return result
+
+class _Download:
+    """An in-progress fetch; readers follow its .part file as it grows"""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.content_type = ''
+        self.size = 0
+        self.finished = False
+        self.error = None
+        # Resolved once upstream headers check out and the .part file exists
+        self.ready = asyncio.get_running_loop().create_future()
+        self.progress = asyncio.Condition()
+
+class ImageRelay:
+    def __init__(self, cache_dir: str = IMAGE_CACHE_DIR, max_bytes: int = IMAGE_CACHE_MAX_BYTES):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        # cache key -> metadata of images on disk, least recently used first.
+        # Other workers share the directory, so a listed file may be gone.
+        self.entries = OrderedDict()
+        self.total_bytes = 0
+        self.downloads = {}
+        os.makedirs(cache_dir, exist_ok=True)
+        self._load_index()
+
+    def relay_url(self, url: str) -> str:
+        """Relay path for an upstream image URL.
+
+        The id carries the URL and an HMAC over it, so any worker can verify
+        and serve it without shared state, and only URLs we issued are relayed.
+        """
+        if not url:
+            return url
+        token = base64.urlsafe_b64encode(url.encode()).decode().rstrip('=')
+        return f"{RELAY_PATH}{token}.{_sign(url)}"
+
+    def _decode(self, image_id: str) -> str:
+        match = _ID_RE.match(image_id)
+        if not match:
+            return None
+        token, signature = match.groups()
+        try:
+            url = base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode()
+        except ValueError:
+            return None
+        if not hmac.compare_digest(_sign(url), signature) or not url.startswith(('https://', 'http://')):
+            return None
+        return url
+
+    async def respond(self, image_id: str, headers) -> Response:
+        url = self._decode(image_id)
+        if not url:
+            raise HTTPException(status_code=404, detail="Image not found")
+
+        key = hashlib.sha256(url.encode()).hexdigest()[:32]
+        for _ in range(3):
+            meta = self.entries.get(key) or self._load_entry(key)
+            if meta:
+                self.entries.move_to_end(key)
+                response = self._serve_cached(key, meta, headers)
+                if response:
+                    return response
+                # Evicted by another worker (or right after storing); fetch again
+                self._forget(key)
+
+            # Coalesce misses: one download per image, and every requester
+            # streams from its .part file at its own pace
+            download = self.downloads.get(key)
+            if download is None:
+                download = self._start_download(key, url)
+            await asyncio.shield(download.ready)
+            if download.error:
+                raise download.error
+            try:
+                f = open(download.path, 'rb')
+            except FileNotFoundError:
+                # Finished and moved into the cache while we waited
+                continue
+            return StreamingResponse(
+                self._follow(download, f),
+                media_type=download.content_type,
+                headers={'Cache-Control': CACHE_CONTROL}
+            )
+        raise HTTPException(status_code=502, detail="Failed to fetch image")
+
+    def _path(self, key: str, suffix: str) -> str:
+        return os.path.join(self.cache_dir, f"{key}.{suffix}")
+
+    def _load_index(self):
+        found = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith('.part'):
+                # Only leftovers from a crash; other workers' downloads are younger
+                try:
+                    if time.time() - os.path.getmtime(path) > 2 * IMAGE_FETCH_TIMEOUT:
+                        os.remove(path)
+                except OSError:
+                    pass
+                continue
+            if not name.endswith('.json'):
+                continue
+            key = name[:-5]
+            try:
+                with open(path) as f:
+                    meta = json.load(f)
+                mtime = os.path.getmtime(self._path(key, 'img'))
+            except (OSError, ValueError):
+                continue
+            found.append((mtime, key, meta))
+
+        for _, key, meta in sorted(found):
+            self.entries[key] = meta
+            self.total_bytes += meta['size']
+        self._evict()
+
+    def _load_entry(self, key: str) -> dict:
+        """Pick up an image another worker cached after our index was built"""
+        try:
+            with open(self._path(key, 'json')) as f:
+                meta = json.load(f)
+        except (OSError, ValueError):
+            return None
+        self.entries[key] = meta
+        self.total_bytes += meta['size']
+        self._evict()
+        return self.entries.get(key)
+
+    def _forget(self, key: str):
+        meta = self.entries.pop(key, None)
+        if meta:
+            self.total_bytes -= meta['size']
+
+    def _store(self, key: str, tmp_path: str, meta: dict):
+        os.replace(tmp_path, self._path(key, 'img'))
+        with open(self._path(key, 'json'), 'w') as f:
+            json.dump(meta, f)
+        self._forget(key)
+        self.entries[key] = meta
+        self.total_bytes += meta['size']
+        self._evict()
+
+    def _evict(self):
+        while self.total_bytes > self.max_bytes and self.entries:
+            key, meta = self.entries.popitem(last=False)
+            self.total_bytes -= meta['size']
+            for suffix in ('img', 'json'):
+                try:
+                    os.remove(self._path(key, suffix))
+                except OSError:
+                    pass
+
+    def _start_download(self, key: str, url: str) -> _Download:
+        download = _Download(self._path(key, f"{uuid.uuid4().hex}.part"))
+        self.downloads[key] = download
+        asyncio.create_task(self._fetch(key, url, download))
+        return download
+
+    async def _fetch(self, key: str, url: str, download: _Download):
+        try:
+            await asyncio.wait_for(self._download(key, url, download), IMAGE_FETCH_TIMEOUT)
+        except asyncio.TimeoutError:
+            download.error = HTTPException(status_code=504, detail="Timed out fetching image")
+        except HTTPException as e:
+            download.error = e
+        except (httpx.HTTPError, OSError):
+            download.error = HTTPException(status_code=502, detail="Failed to fetch image")
+        finally:
+            # Same step as marking it finished, so no request joins a download
+            # whose .part file has already been moved or removed
+            self.downloads.pop(key, None)
+
+        download.finished = True
+        if not download.ready.done():
+            download.ready.set_exception(download.error)
+            # Mark it retrieved even if every waiter has gone away
+            download.ready.exception()
+        async with download.progress:
+            download.progress.notify_all()
+        if download.error and os.path.exists(download.path):
+            os.remove(download.path)
+
+    async def _download(self, key: str, url: str, download: _Download):
+        digest = hashlib.sha256()
+        async with get_http_client().stream('GET', url) as upstream:
+            content_type = upstream.headers.get('content-type', '')
+            if upstream.status_code != 200 or not content_type.startswith('image/'):
+                raise HTTPException(status_code=502, detail="Failed to fetch image")
+            declared = upstream.headers.get('content-length', '')
+            if declared.isdigit() and int(declared) > IMAGE_MAX_BYTES:
+                raise HTTPException(status_code=502, detail="Image too large")
+
+            # Straight to disk; the image is never held in memory
+            with open(download.path, 'wb') as f:
+                download.content_type = content_type
+                download.ready.set_result(None)
+                async for chunk in upstream.aiter_bytes(CHUNK_SIZE):
+                    if download.size + len(chunk) > IMAGE_MAX_BYTES:
+                        raise HTTPException(status_code=502, detail="Image too large")
+                    f.write(chunk)
+                    f.flush()
+                    digest.update(chunk)
+                    download.size += len(chunk)
+                    async with download.progress:
+                        download.progress.notify_all()
+
+        self._store(key, download.path, {
+            'url': url,
+            'content_type': content_type,
+            'etag': f'"{digest.hexdigest()[:32]}"',
+            'size': download.size
+        })
+
+    async def _follow(self, download: _Download, f):
+        """Stream a download's bytes as they land on disk"""
+        position = 0
+        try:
+            while True:
+                if position < download.size:
+                    chunk = f.read(min(CHUNK_SIZE, download.size - position))
+                    if not chunk:
+                        raise HTTPException(status_code=502, detail="Failed to fetch image")
+                    position += len(chunk)
+                    yield chunk
+                    continue
+                if download.error:
+                    # Abort the response rather than end a truncated image cleanly
+                    raise download.error
+                if download.finished:
+                    return
+                async with download.progress:
+                    await download.progress.wait_for(
+                        lambda: download.size > position or download.finished
+                    )
+        finally:
+            f.close()
+
+    def _serve_cached(self, key: str, meta: dict, headers) -> Response:
+        """Response for a cached image, or None if its file has disappeared"""
+        etag = meta['etag']
+        size = meta['size']
+        base_headers = {
+            'ETag': etag,
+            'Cache-Control': CACHE_CONTROL,
+            'Accept-Ranges': 'bytes'
+        }
+
+        if etag_matches(headers.get('if-none-match'), etag):
+            return Response(status_code=304, headers=base_headers)
+
+        start, end = 0, size - 1
+        status_code = 200
+        range_header = headers.get('range')
+        if_range = headers.get('if-range')
+        if range_header and (not if_range or if_range == etag):
+            match = _RANGE_RE.match(range_header.strip())
+            if match and (match.group(1) or match.group(2)):
+                if match.group(1):
+                    start = int(match.group(1))
+                    if match.group(2):
+                        end = min(int(match.group(2)), size - 1)
+                else:
+                    start = max(0, size - int(match.group(2)))
+                if start > end or start >= size:
+                    return Response(status_code=416, headers={'Content-Range': f"bytes */{size}"})
+                status_code = 206
+                base_headers['Content-Range'] = f"bytes {start}-{end}/{size}"
+
+        # Open before any header goes out, so a vanished file can still be refetched
+        try:
+            f = open(self._path(key, 'img'), 'rb')
+        except FileNotFoundError:
+            return None
+
+        base_headers['Content-Length'] = str(end - start + 1)
+        return StreamingResponse(
+            self._read(f, start, end),
+            status_code=status_code,
+            media_type=meta['content_type'],
+            headers=base_headers
+        )
+
+    def _read(self, f, start: int, end: int):
+        # Sync generator: Starlette iterates it in its threadpool
+        try:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    break
+                remaining -= len(chunk)
+                yield chunk
+        finally:
+            f.close()
+
+image_relay = ImageRelay()
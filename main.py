@@ -1,11 +1,13 @@
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 from slowapi import Limiter, _rate_limit_exceeded_handler
-from slowapi.util import get_remote_address
 from slowapi.errors import RateLimitExceeded
-from routes import router as parse_router
+from routes import router as parse_router, get_client_ip
+import asyncio
+from http_client import close_http_client
+from prefetch import prefetch_trending
 
-limiter = Limiter(key_func=get_remote_address)
+limiter = Limiter(key_func=get_client_ip)
 app = FastAPI(title="SaveTubeX API", version="1.0.0")
 app.state.limiter = limiter
 app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
@@ -23,11 +25,21 @@ app.add_middleware(
     allow_origins=allowed_origins,
     allow_credentials=False,
     allow_methods=["GET", "POST"],
-    allow_headers=["Content-Type"],
+    allow_headers=["Content-Type", "If-None-Match", "Range"],
+    expose_headers=["ETag", "Content-Range"],
 )
 
 app.include_router(parse_router, prefix="/api")
 
+@app.on_event("startup")
+async def startup():
+    app.state.prefetch_task = asyncio.create_task(prefetch_trending())
+
+@app.on_event("shutdown")
+async def shutdown():
+    app.state.prefetch_task.cancel()
+    await close_http_client()
+
 @app.get("/")
 async def root():
     return {"message": "SaveTubeX API - Media URL Parser"}
\ No newline at end of file
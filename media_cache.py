@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from urllib.parse import urlparse, parse_qs
+from trending import trending
+
+MEDIA_CACHE_SIZE = 512
+DEFAULT_TTL = 3600
+# Stop serving a result this long before its links expire
+EXPIRY_MARGIN = 60
+
+def url_expiry(url: str) -> float:
+    """Expiry timestamp embedded in a signed media URL, if any"""
+    query = parse_qs(urlparse(url).query)
+    try:
+        if 'expire' in query:
+            # googlevideo.com
+            return float(query['expire'][0])
+        if 'oe' in query:
+            # fbcdn.net / cdninstagram.com, hex encoded
+            return float(int(query['oe'][0], 16))
+    except ValueError:
+        pass
+    return None
+
+def result_expiry(result: dict) -> float:
+    """Earliest signed-URL expiry among a parse result's formats"""
+    expiries = [url_expiry(fmt['url']) for fmt in result.get('formats', [])]
+    expiries = [expiry for expiry in expiries if expiry]
+    return min(expiries) if expiries else time.time() + DEFAULT_TTL
+
+class MediaCache:
+    """LRU cache of parse results keyed by canonical media ID.
+
+    Entries live until their earliest format link expires. When full, a new
+    ID only displaces the least recently used one if the trending sketch has
+    seen it more often, so a stream of one-off URLs can't flush hot items.
+    """
+
+    def __init__(self, capacity: int = MEDIA_CACHE_SIZE):
+        self.capacity = capacity
+        # id -> (expires_at, result)
+        self.entries = OrderedDict()
+
+    def get(self, media_id: str) -> dict:
+        entry = self.entries.get(media_id)
+        if not entry:
+            return None
+        expires_at, result = entry
+        if expires_at - EXPIRY_MARGIN <= time.time():
+            del self.entries[media_id]
+            return None
+        self.entries.move_to_end(media_id)
+        return result
+
+    def expires_at(self, media_id: str) -> float:
+        entry = self.entries.get(media_id)
+        return entry[0] if entry else None
+
+    def put(self, media_id: str, result: dict) -> bool:
+        expires_at = result_expiry(result)
+        if media_id in self.entries:
+            self.entries[media_id] = (expires_at, result)
+            self.entries.move_to_end(media_id)
+            return True
+
+        if len(self.entries) >= self.capacity:
+            self._purge_expired()
+        if len(self.entries) >= self.capacity:
+            victim = next(iter(self.entries))
+            if trending.estimate(media_id) <= trending.estimate(victim):
+                return False
+            del self.entries[victim]
+
+        self.entries[media_id] = (expires_at, result)
+        return True
+
+    def _purge_expired(self):
+        now = time.time()
+        for media_id in [key for key, (expires_at, _) in self.entries.items() if expires_at - EXPIRY_MARGIN <= now]:
+            del self.entries[media_id]
+
+media_cache = MediaCache()
@@ -1,16 +1,24 @@
 import re
 import yt_dlp
 import random
-import time
 import httpx
 import json
+import asyncio
 from collections import defaultdict
+from urllib.parse import urlparse, parse_qs, urlencode
 from validators import URLValidator
+from image_relay import image_relay
+from scheduler import extraction_scheduler, client_key, INTERACTIVE
+from media_cache import media_cache
+from trending import trending
 
 ip_usage_counter = defaultdict(int)
 ip_view_counter = defaultdict(int)
 USAGE_LIMIT = 2
 VIEW_LIMIT = 2
+PLAYLIST_PAGE_SIZE = 50
+PLAYLIST_CONCURRENCY = 4
+MAX_RETRIES = 5
 
 class MediaParser:
     def __init__(self):
@@ -56,37 +64,223 @@ class MediaParser:
             'retries': 3
         }
 
-    async def parse_url(self, url: str, client_ip: str = None) -> dict:
-        if client_ip and ip_usage_counter[client_ip] >= USAGE_LIMIT:
+    def _get_flat_opts(self, cursor: int, limit: int):
+        opts = self._get_ydl_opts()
+        opts.update({
+            'extract_flat': 'in_playlist',
+            'lazy_playlist': True,
+            # Carousel images have no formats and broken items shouldn't sink
+            # the whole page; both come through as entries (None on failure)
+            'ignore_no_formats_error': True,
+            'ignoreerrors': True,
+            # One extra entry past the page tells us whether a next page exists
+            'playliststart': cursor + 1,
+            'playlistend': cursor + limit + 1
+        })
+        return opts
+
+    def _extract(self, url: str, opts: dict = None) -> dict:
+        """Blocking yt-dlp extraction; run it in a worker thread"""
+        with yt_dlp.YoutubeDL(opts or self._get_ydl_opts()) as ydl:
+            return ydl.extract_info(url, download=False)
+
+    async def expand_url(self, url: str, client_ip: str = None, cursor: int = 0, limit: int = PLAYLIST_PAGE_SIZE):
+        """Expand a playlist or carousel URL into a stream of resolved entries.
+
+        Checks and the flat listing run up front so errors surface before
+        streaming starts; the returned async generator yields one dict per
+        entry as it resolves, followed by a final {'next_cursor': ...} dict.
+        Every resolved entry counts against the client's usage limit, so the
+        page is capped at the remaining quota.
+        """
+        if client_ip:
+            remaining = USAGE_LIMIT - ip_usage_counter[client_ip]
+            if remaining <= 0:
+                raise ValueError("LIMIT_REACHED")
+            limit = min(limit, remaining)
+
+        # Multi-image carousels live at instagram.com/p/...
+        self.validator.is_public_url(url, allow_posts=True)
+        platform = self._detect_platform(url)
+
+        try:
+            info = await extraction_scheduler.run(client_key(client_ip), INTERACTIVE, self._extract, url, self._get_flat_opts(cursor, limit))
+        except ValueError:
+            raise
+        except Exception:
+            raise ValueError("Unable to process playlist: Please try again later")
+        if not info:
+            # ignoreerrors turns a failed listing into None instead of raising
+            raise ValueError("Unable to process playlist: Please try again later")
+        self.validator.validate_content_type(info)
+
+        return self._stream_entries(info, platform, cursor, limit, client_ip)
+
+    async def _stream_entries(self, info: dict, platform: str, cursor: int, limit: int, client_ip: str = None):
+        if info.get('_type') not in ('playlist', 'multi_video'):
+            yield await self._resolve_entry(info, platform, cursor, client_ip)
+            yield {'next_cursor': None}
+            return
+
+        # yt-dlp has already materialised this page (plus one look-ahead entry) as a list
+        entries = list(info.get('entries') or [])
+        pending = set()
+        try:
+            for index, entry in enumerate(entries[:limit], start=cursor):
+                pending.add(asyncio.create_task(self._resolve_entry(entry, platform, index, client_ip)))
+                if len(pending) >= PLAYLIST_CONCURRENCY:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield task.result()
+
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield task.result()
+
+            yield {'next_cursor': cursor + limit if len(entries) > limit else None}
+        finally:
+            for task in pending:
+                task.cancel()
+
+    async def _resolve_entry(self, entry: dict, platform: str, index: int, client_ip: str = None) -> dict:
+        try:
+            if client_ip and ip_usage_counter[client_ip] >= USAGE_LIMIT:
+                raise ValueError("LIMIT_REACHED")
+            if entry is None:
+                raise ValueError("This item is unavailable")
+            if entry.get('_type') in ('url', 'url_transparent'):
+                # Each item competes for extraction slots like any other request from this client
+                entry = await extraction_scheduler.run(client_key(client_ip), INTERACTIVE, self._extract, entry['url'])
+            self.validator.validate_content_type(entry)
+            result = {'index': index, **self._format_response(entry, platform)}
+            if client_ip:
+                ip_usage_counter[client_ip] += 1
+            return result
+        except Exception as e:
+            return {'index': index, 'error': str(e) if isinstance(e, ValueError) else "Unable to process entry"}
+
+    async def parse_url(self, url: str, client_ip: str = None, priority: int = INTERACTIVE, refresh: bool = False, count_usage: bool = True) -> dict:
+        """Parse a URL, serving from the media cache when possible.
+
+        `refresh` skips the cache lookup and trending count and makes a single
+        attempt; the prefetcher uses it to re-extract hot items before their
+        links expire. URLs without a canonical media ID bypass the cache.
+        With `count_usage` off the caller enforces and records usage itself.
+        """
+        count_usage = count_usage and client_ip
+        if count_usage and ip_usage_counter[client_ip] >= USAGE_LIMIT:
             raise ValueError("LIMIT_REACHED")
         
         self.validator.is_public_url(url)
+        media_id = self.canonical_id(url)
+        
+        if media_id and not refresh:
+            trending.observe(media_id, url)
+            cached = media_cache.get(media_id)
+            if cached:
+                if count_usage:
+                    ip_usage_counter[client_ip] += 1
+                return cached
+        
+        # Only actual extraction competes for slots; cache hits never queue
+        result = await self._parse_uncached(url, client_ip, priority, 1 if refresh else MAX_RETRIES)
+        if media_id:
+            media_cache.put(media_id, result)
+        if count_usage:
+            ip_usage_counter[client_ip] += 1
+        return result
+
+    def canonical_id(self, url: str) -> str:
+        """Platform-qualified media ID shared by every URL form of the same item.
+
+        None when the URL doesn't identify a single media item (channels,
+        playlists, profile pages, ...); such URLs must bypass shared caches.
+        """
+        canonical = self._canonical(url)
+        return canonical[0] if canonical else None
+
+    def canonical_url(self, url: str) -> str:
+        """Single URL form for a media item, so caches keyed by URL converge"""
+        canonical = self._canonical(url)
+        return canonical[1] if canonical else None
+
+    def _canonical(self, url: str) -> tuple:
+        platform = self._detect_platform(url)
+        parsed = urlparse(url)
+        host = parsed.netloc.lower().removeprefix('www.').removeprefix('m.')
+        path = parsed.path.rstrip('/')
+        query = {key: values[0] for key, values in parse_qs(parsed.query).items()}
+        
+        if platform == 'youtube':
+            video_id = self._extract_video_id(url)
+            if video_id:
+                return f"youtube:{video_id}", f"https://www.youtube.com/watch?v={video_id}"
+            return None
+        
+        if platform == 'instagram':
+            match = re.fullmatch(r'(?:/[^/]+)?/(p|reels?|tv)/([0-9A-Za-z_-]+)', path)
+            if match:
+                kind = 'reel' if match.group(1) == 'reels' else match.group(1)
+                return f"instagram:{match.group(2)}", f"https://www.instagram.com/{kind}/{match.group(2)}"
+            return None
+        
+        if host == 'fb.watch':
+            match = re.fullmatch(r'/([0-9A-Za-z_-]+)', path)
+            if match:
+                return f"facebook:fb.watch/{match.group(1)}", f"https://fb.watch/{match.group(1)}"
+            return None
+        
+        fb_id = r'[0-9A-Za-z_-]+'
+        video_match = (re.fullmatch(r'/[^/]+/videos/(?:[^/]+/)?(\d+)', path) or
+                       re.fullmatch(r'/(?:reel|watch)/(\d+)', path))
+        video_id = query.get('v') if path in ('/watch', '/video.php') else None
+        if video_match:
+            video_id = video_match.group(1)
+        if video_id and re.fullmatch(fb_id, video_id):
+            return f"facebook:{video_id}", f"https://www.facebook.com/watch?{urlencode({'v': video_id})}"
+        
+        story_fbid, owner_id = query.get('story_fbid'), query.get('id')
+        if path == '/permalink.php' and story_fbid and owner_id and re.fullmatch(fb_id, story_fbid) and re.fullmatch(fb_id, owner_id):
+            return (f"facebook:{owner_id}_{story_fbid}",
+                    f"https://www.facebook.com/permalink.php?{urlencode({'story_fbid': story_fbid, 'id': owner_id})}")
+        
+        fbid = query.get('fbid')
+        if path == '/photo.php' or path == '/photo':
+            if fbid and re.fullmatch(fb_id, fbid):
+                return f"facebook:{fbid}", f"https://www.facebook.com/photo.php?{urlencode({'fbid': fbid})}"
+        return None
+
+    async def _parse_uncached(self, url: str, client_ip: str = None, priority: int = INTERACTIVE, max_retries: int = MAX_RETRIES) -> dict:
         platform = self._detect_platform(url)
+        key = client_key(client_ip)
         
         # Try fallback method first for YouTube
         if platform == 'youtube':
             try:
-                return await self._youtube_fallback(url, client_ip)
-            except:
+                async with extraction_scheduler.slot(key, priority):
+                    return await self._youtube_fallback(url)
+            except ValueError as e:
+                if str(e) == "SERVER_BUSY":
+                    raise
+            except Exception:
                 pass  # Continue to yt-dlp method
         
-        max_retries = 5
         for attempt in range(max_retries):
             try:
                 if attempt > 0:
                     delay = random.uniform(3, 8) * (attempt + 1)
-                    time.sleep(delay)
+                    # Backoff happens outside any slot; each attempt queues again
+                    await asyncio.sleep(delay)
                 
-                with yt_dlp.YoutubeDL(self._get_ydl_opts()) as ydl:
-                    info = ydl.extract_info(url, download=False)
-                    self.validator.validate_content_type(info)
-                    
-                    if client_ip:
-                        ip_usage_counter[client_ip] += 1
-                    
-                    return self._format_response(info, platform)
+                info = await extraction_scheduler.run(key, priority, self._extract, url)
+                self.validator.validate_content_type(info)
+                
+                return self._format_response(info, platform)
                     
             except Exception as e:
+                if str(e) == "SERVER_BUSY":
+                    raise
                 error_msg = str(e).lower()
                 if attempt == max_retries - 1:
                     if any(keyword in error_msg for keyword in ['sign in', 'bot', 'captcha', 'verify']):
@@ -176,7 +370,7 @@ class MediaParser:
                     label = f"Thumbnail {thumb.get('width', 'HD')}x{thumb.get('height', '')}"
                     images.append({
                         'label': label,
-                        'url': thumb['url']
+                        'url': image_relay.relay_url(thumb['url'])
                     })
         
         all_formats = video_formats + audio_formats
@@ -184,7 +378,7 @@ class MediaParser:
         return {
             'platform': platform,
             'title': info.get('title', 'Unknown'),
-            'thumbnail': info.get('thumbnail', ''),
+            'thumbnail': image_relay.relay_url(info.get('thumbnail', '')),
             'formats': all_formats,
             'images': images
         }
@@ -236,135 +430,7 @@ class MediaParser:
         
         return fmt.get('format_note', 'unknown')
     
-    async def _youtube_fallback(self, url: str, client_ip: str = None) -> dict:
-        """Fallback using reliable external service"""
-        video_id = self._extract_video_id(url)
-        if not video_id:
-            raise ValueError("Invalid YouTube URL")
-        
-        headers = {
-            'User-Agent': random.choice(self.user_agents),
-            'Accept': 'application/json'
-        }
-        
-        async with httpx.AsyncClient(headers=headers, timeout=30) as client:
-            # Get basic video info
-            try:
-                oembed_url = f"https://www.youtube.com/oembed?url={url}&format=json"
-                response = await client.get(oembed_url)
-                
-                if response.status_code == 200:
-                    data = response.json()
-                    title = data.get('title', 'YouTube Video')
-                    thumbnail = data.get('thumbnail_url', f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg")
-                    
-                    # Create download formats using working services
-                    formats = [
-                        {
-                            'quality': '720p MP4',
-                            'url': f"https://loader.to/api/button/?f=720&k={video_id}",
-                            'type': 'video'
-                        },
-                        {
-                            'quality': '480p MP4', 
-                            'url': f"https://loader.to/api/button/?f=480&k={video_id}",
-                            'type': 'video'
-                        },
-                        {
-                            'quality': '360p MP4',
-                            'url': f"https://loader.to/api/button/?f=360&k={video_id}", 
-                            'type': 'video'
-                        },
-                        {
-                            'quality': 'Audio MP3',
-                            'url': f"https://loader.to/api/button/?f=mp3&k={video_id}",
-                            'type': 'audio'
-                        },
-                        {
-                            'quality': 'Audio M4A',
-                            'url': f"https://loader.to/api/button/?f=m4a&k={video_id}",
-                            'type': 'audio'
-                        }
-                    ]
-                    
-                    if client_ip:
-                        ip_usage_counter[client_ip] += 1
-                    
-                    return {
-                        'platform': 'youtube',
-                        'title': title,
-                        'thumbnail': thumbnail,
-                        'formats': formats,
-                        'images': [{
-                            'label': 'Thumbnail',
-                            'url': thumbnail
-                        }]
-                    }
-            except:
-                pass
-            
-            # Final fallback with generic title
-            thumb_url = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-            
-            formats = [
-                {
-                    'quality': 'Download 720p',
-                    'url': f"https://ssyoutube.com/watch?v={video_id}",
-                    'type': 'video'
-                },
-                {
-                    'quality': 'Download 480p',
-                    'url': f"https://y2mate.com/youtube/{video_id}",
-                    'type': 'video'
-                },
-                {
-                    'quality': 'Download MP3',
-                    'url': f"https://ytmp3.cc/youtube-to-mp3/{video_id}",
-                    'type': 'audio'
-                }
-            ]
-            
-            if client_ip:
-                ip_usage_counter[client_ip] += 1
-            
-            return {
-                'platform': 'youtube',
-                'title': f'YouTube Video {video_id}',
-                'thumbnail': thumb_url,
-                'formats': formats,
-                'images': [{
-                    'label': 'Thumbnail',
-                    'url': thumb_url
-                }]
-            }
-
-    
-    def _extract_video_id(self, url: str) -> str:
-        """Extract YouTube video ID from URL"""
-        patterns = [
-            r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-            r'(?:embed\/)([0-9A-Za-z_-]{11})',
-            r'(?:youtu\.be\/)([0-9A-Za-z_-]{11})'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, url)
-            if match:
-                return match.group(1)
-        return None
-        
-        if fmt.get('resolution'):
-            resolution = fmt['resolution']
-            if 'x' in resolution:
-                try:
-                    height = int(resolution.split('x')[1])
-                    return f"{height}p"
-                except (ValueError, IndexError):
-                    pass
-        
-        return fmt.get('format_note', 'unknown')
-    
-    async def _youtube_fallback(self, url: str, client_ip: str = None) -> dict:
+    async def _youtube_fallback(self, url: str) -> dict:
         """Enhanced fallback method using YouTube player API"""
         video_id = self._extract_video_id(url)
         if not video_id:
@@ -401,7 +467,7 @@ class MediaParser:
                     # Extract video details
                     video_details = data.get('videoDetails', {})
                     title = video_details.get('title', 'YouTube Video')
-                    thumbnail = video_details.get('thumbnail', {}).get('thumbnails', [{}])[-1].get('url', f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg")
+                    thumbnail = image_relay.relay_url(video_details.get('thumbnail', {}).get('thumbnails', [{}])[-1].get('url', f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"))
                     
                     # Extract streaming data
                     streaming_data = data.get('streamingData', {})
@@ -447,9 +513,6 @@ class MediaParser:
                     # Combine all formats
                     all_formats = formats + video_formats + audio_formats[:2]  # Limit audio formats
                     
-                    if client_ip:
-                        ip_usage_counter[client_ip] += 1
-                    
                     return {
                         'platform': 'youtube',
                         'title': title,
@@ -476,10 +539,7 @@ class MediaParser:
                 html = response.text
                 title_match = re.search(r'"title":"([^"]+)"', html)
                 title = title_match.group(1) if title_match else "YouTube Video"
-                thumb_url = f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg"
-                
-                if client_ip:
-                    ip_usage_counter[client_ip] += 1
+                thumb_url = image_relay.relay_url(f"https://img.youtube.com/vi/{video_id}/maxresdefault.jpg")
                 
                 return {
                     'platform': 'youtube',
@@ -501,9 +561,9 @@ class MediaParser:
     def _extract_video_id(self, url: str) -> str:
         """Extract YouTube video ID from URL"""
         patterns = [
-            r'(?:v=|\/)([0-9A-Za-z_-]{11}).*',
-            r'(?:embed\/)([0-9A-Za-z_-]{11})',
-            r'(?:youtu\.be\/)([0-9A-Za-z_-]{11})'
+            r'youtube\.com/watch\?(?:[^#]*&)?v=([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])',
+            r'youtube\.com/(?:shorts|embed)/([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])',
+            r'youtu\.be/([0-9A-Za-z_-]{11})(?![0-9A-Za-z_-])'
         ]
         
         for pattern in patterns:
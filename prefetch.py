@@ -0,0 +1,45 @@
+import time
+import asyncio
+from parser import MediaParser
+from media_cache import media_cache
+from scheduler import BACKGROUND
+from trending import trending
+
+PREFETCH_INTERVAL = 60
+PREFETCH_TOP_K = 20
+PREFETCH_MIN_COUNT = 3
+# Re-extract hot items this long before their cached links expire
+PREFETCH_LEAD = 600
+PREFETCH_MAX_BACKOFF = 86400
+
+async def prefetch_trending():
+    """Keep the current top-K media IDs warm in the media cache"""
+    parser = MediaParser()
+    # id -> (retry_at, consecutive failures), for ids that failed to refresh
+    failures = {}
+    while True:
+        await asyncio.sleep(PREFETCH_INTERVAL)
+        top = trending.top(PREFETCH_TOP_K)
+        for item in top:
+            if item['count'] - item['error'] < PREFETCH_MIN_COUNT:
+                continue
+            expires_at = media_cache.expires_at(item['id'])
+            if expires_at and expires_at - time.time() > PREFETCH_LEAD:
+                continue
+            failure = failures.get(item['id'])
+            if failure and failure[0] > time.time():
+                continue
+            try:
+                await parser.parse_url(item['url'], priority=BACKGROUND, refresh=True)
+                failures.pop(item['id'], None)
+            except Exception as e:
+                if str(e) == "SERVER_BUSY":
+                    # Interactive traffic has the slots; leave the rest for next round
+                    break
+                # Private or removed media fails every time: back off exponentially
+                count = failure[1] + 1 if failure else 1
+                failures[item['id']] = (time.time() + min(PREFETCH_INTERVAL * 2 ** count, PREFETCH_MAX_BACKOFF), count)
+
+        trending_ids = {item['id'] for item in top}
+        for media_id in [media_id for media_id in failures if media_id not in trending_ids]:
+            del failures[media_id]
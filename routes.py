@@ -1,15 +1,52 @@
-from fastapi import APIRouter, HTTPException, Request
+import os
+import json
+import time
+import hashlib
+import secrets
+from urllib.parse import quote
+from fastapi import APIRouter, Header, HTTPException, Request
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import RedirectResponse, Response, StreamingResponse
 from slowapi import Limiter
 from slowapi.util import get_remote_address
-from pydantic import BaseModel, HttpUrl
-from parser import MediaParser, ip_view_counter, VIEW_LIMIT
+from pydantic import BaseModel, Field, HttpUrl
+from parser import MediaParser, ip_usage_counter, ip_view_counter, USAGE_LIMIT, VIEW_LIMIT, PLAYLIST_PAGE_SIZE
+from image_relay import image_relay, absolute_urls, etag_matches
+from scheduler import extraction_scheduler
+from media_cache import media_cache, result_expiry, EXPIRY_MARGIN
+from trending import trending
 
-limiter = Limiter(key_func=get_remote_address)
+ADMIN_TOKEN = os.environ.get('ADMIN_TOKEN', '')
+# Origin clients should load relayed images from; defaults to the request's own
+PUBLIC_BASE_URL = os.environ.get('PUBLIC_BASE_URL', '')
+# Header the CDN puts the real client address in (e.g. Fastly-Client-IP). Only
+# set it when every request arrives through an edge that overwrites it.
+# Rate limits and usage are keyed on it, and GET /parse is edge-cached only
+# when it is set, varied on it, so the per-IP limits still hold. The CDN must
+# honour Vary on this header (or key its cache on it); Cloudflare, for one,
+# ignores Vary on anything but Accept-Encoding and must not be used with it.
+CLIENT_IP_HEADER = os.environ.get('CLIENT_IP_HEADER', '')
+CANONICAL_REDIRECT_MAX_AGE = 86400
+NO_STORE = {"Cache-Control": "private, no-store"}
+
+def get_client_ip(request: Request) -> str:
+    if CLIENT_IP_HEADER:
+        forwarded = request.headers.get(CLIENT_IP_HEADER)
+        if forwarded:
+            return forwarded.split(',')[0].strip()
+    return get_remote_address(request)
+
+limiter = Limiter(key_func=get_client_ip)
 router = APIRouter()
 
 class ParseRequest(BaseModel):
     url: HttpUrl
 
+class ExpandRequest(BaseModel):
+    url: HttpUrl
+    cursor: int = Field(0, ge=0)
+    limit: int = Field(PLAYLIST_PAGE_SIZE, ge=1, le=PLAYLIST_PAGE_SIZE)
+
 class MediaFormat(BaseModel):
     quality: str
     url: str
@@ -26,27 +63,165 @@ class ParseResponse(BaseModel):
     formats: list[MediaFormat]
     images: list[ImageFormat] = []
 
+def _public_base(request: Request) -> str:
+    return (PUBLIC_BASE_URL or str(request.base_url)).rstrip('/')
+
+def _require_admin(token: str):
+    if not ADMIN_TOKEN or not secrets.compare_digest(token, ADMIN_TOKEN):
+        raise HTTPException(status_code=403, detail="Forbidden")
+
+def _parse_error(e: ValueError, headers: dict = None) -> HTTPException:
+    if str(e) == "LIMIT_REACHED":
+        return HTTPException(
+            status_code=429,
+            detail={
+                "error": "LIMIT_REACHED",
+                "message": "Free limit reached. Please sign in to continue."
+            },
+            headers=headers
+        )
+    if str(e) == "SERVER_BUSY":
+        return HTTPException(
+            status_code=503,
+            detail={
+                "error": "SERVER_BUSY",
+                "message": "Server is busy. Please try again shortly."
+            },
+            headers={**(headers or {}), "Retry-After": "5"}
+        )
+    return HTTPException(status_code=400, detail=str(e), headers=headers)
+
 @router.post("/parse", response_model=ParseResponse)
 @limiter.limit("10/minute")
 async def parse_media(request: Request, data: ParseRequest):
     try:
         parser = MediaParser()
-        client_ip = get_remote_address(request)
+        client_ip = get_client_ip(request)
         result = await parser.parse_url(str(data.url), client_ip)
-        return ParseResponse(**result)
+        return ParseResponse(**absolute_urls(result, _public_base(request)))
     except ValueError as e:
-        if str(e) == "LIMIT_REACHED":
-            raise HTTPException(
-                status_code=429, 
-                detail={
-                    "error": "LIMIT_REACHED",
-                    "message": "Free limit reached. Please sign in to continue."
-                }
+        raise _parse_error(e)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Failed to parse media URL")
+
+@router.get("/parse", response_model=ParseResponse)
+@limiter.limit("10/minute")
+async def parse_media_cacheable(request: Request, url: HttpUrl):
+    """Cacheable variant of POST /parse.
+
+    Any URL form of a media item is redirected to its canonical URL so caches
+    share one entry per item. Responses carry a strong ETag and, when
+    CLIENT_IP_HEADER is configured, s-maxage up to the earliest signed-link
+    expiry. Revalidations answered with 304 don't count against the usage
+    limit; errors are never stored.
+    """
+    parser = MediaParser()
+    client_ip = get_client_ip(request)
+    if_none_match = request.headers.get('if-none-match')
+    try:
+        parser.validator.is_public_url(str(url))
+        canonical = parser.canonical_url(str(url))
+        if canonical and str(url).rstrip('/') != canonical:
+            return RedirectResponse(
+                f"{request.url.path}?url={quote(canonical, safe='')}",
+                status_code=308,
+                headers={"Cache-Control": f"public, max-age={CANONICAL_REDIRECT_MAX_AGE}"}
             )
-        raise HTTPException(status_code=400, detail=str(e))
+    except ValueError as e:
+        raise _parse_error(e, NO_STORE)
+
+    media_id = parser.canonical_id(str(url))
+    if ip_usage_counter.get(client_ip, 0) >= USAGE_LIMIT:
+        # A client over its limit may still revalidate what it already has,
+        # but only against the media cache; it never triggers an extraction
+        cached = media_cache.get(media_id) if media_id and if_none_match else None
+        if cached:
+            _, headers = _cacheable_response(request, media_id, cached)
+            if etag_matches(if_none_match, headers["ETag"]):
+                return Response(status_code=304, headers=headers)
+        raise _parse_error(ValueError("LIMIT_REACHED"), NO_STORE)
+
+    try:
+        result = await parser.parse_url(str(url), client_ip, count_usage=False)
+    except ValueError as e:
+        raise _parse_error(e, NO_STORE)
+    except Exception as e:
+        raise HTTPException(status_code=500, detail="Failed to parse media URL", headers=NO_STORE)
+
+    body, headers = _cacheable_response(request, media_id, result)
+    if etag_matches(if_none_match, headers["ETag"]):
+        return Response(status_code=304, headers=headers)
+    ip_usage_counter[client_ip] += 1
+    return Response(content=body, media_type="application/json", headers=headers)
+
+def _cacheable_response(request: Request, media_id: str, result: dict) -> tuple:
+    """Serialised body and caching headers for a GET /parse result"""
+    body = json.dumps(jsonable_encoder(ParseResponse(**absolute_urls(result, _public_base(request)))), separators=(',', ':')).encode()
+    etag = f'"{hashlib.sha256(body).hexdigest()[:32]}"'
+    expires_at = media_cache.expires_at(media_id) or result_expiry(result)
+    ttl = int(expires_at - EXPIRY_MARGIN - time.time())
+    if not media_id or ttl <= 0:
+        cache_control = "private, no-store"
+    elif CLIENT_IP_HEADER:
+        cache_control = f"public, max-age=0, s-maxage={ttl}"
+    else:
+        # Without a trusted client-IP header the edge can't tell clients
+        # apart, so sharing responses there would bypass the usage limit
+        cache_control = "private, max-age=0"
+    return body, {
+        "ETag": etag,
+        "Cache-Control": cache_control,
+        "Vary": f"Accept-Encoding, {CLIENT_IP_HEADER}" if CLIENT_IP_HEADER else "Accept-Encoding"
+    }
+
+@router.post("/parse/expand")
+@limiter.limit("10/minute")
+async def expand_media(request: Request, data: ExpandRequest):
+    """Stream playlist or carousel entries as NDJSON, one line per resolved entry.
+
+    Entries arrive in completion order and carry their playlist `index`; the
+    last line holds `next_cursor` (null when there are no more pages).
+    """
+    try:
+        parser = MediaParser()
+        client_ip = get_client_ip(request)
+        entries = await parser.expand_url(str(data.url), client_ip, data.cursor, data.limit)
+    except ValueError as e:
+        raise _parse_error(e)
     except Exception as e:
         raise HTTPException(status_code=500, detail="Failed to parse media URL")
 
+    base_url = _public_base(request)
+
+    async def ndjson():
+        async for entry in entries:
+            yield json.dumps(absolute_urls(entry, base_url)) + "\n"
+
+    return StreamingResponse(ndjson(), media_type="application/x-ndjson")
+
+@router.get("/image/{image_id}")
+async def relay_image(request: Request, image_id: str):
+    """Serve a thumbnail or carousel image through our own cache instead of the platform CDN"""
+    return await image_relay.respond(image_id, request.headers)
+
+@router.get("/admin/scheduler")
+async def get_scheduler_stats(x_admin_token: str = Header(default='')):
+    """Extraction slot usage, queue depth and queue-wait percentiles"""
+    _require_admin(x_admin_token)
+    return extraction_scheduler.get_stats()
+
+@router.get("/admin/trending")
+async def get_trending(k: int = 20, x_admin_token: str = Header(default='')):
+    """Current heavy hitters among parsed media IDs and whether each is cached"""
+    _require_admin(x_admin_token)
+    return {
+        'items': [
+            {**item, 'cached_until': media_cache.expires_at(item['id'])}
+            for item in trending.top(max(1, min(k, 100)))
+        ],
+        'cache_size': len(media_cache.entries)
+    }
+
 @router.get("/usage/{ip}")
 async def get_usage(ip: str):
     return {
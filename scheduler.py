@@ -0,0 +1,154 @@
+import time
+import heapq
+import asyncio
+import ipaddress
+from collections import defaultdict, deque
+from contextlib import asynccontextmanager
+
+EXTRACTION_SLOTS = 4
+INTERACTIVE = 0
+BACKGROUND = 1
+QUEUE_LIMITS = {
+    INTERACTIVE: 64,
+    BACKGROUND: 16
+}
+FAIR_SHARE_PREFIX_V4 = 24
+FAIR_SHARE_PREFIX_V6 = 64
+WAIT_SAMPLES = 1000
+
+def client_key(ip: str) -> str:
+    """Fair-share key for a client: its /24 (IPv4) or /64 (IPv6) network.
+
+    Grouping by subnet stops a block of addresses from outvoting everyone
+    else. Signed-in accounts can pass their own key to the scheduler instead.
+    """
+    try:
+        address = ipaddress.ip_address(ip)
+    except ValueError:
+        return ip or 'unknown'
+    prefix = FAIR_SHARE_PREFIX_V4 if address.version == 4 else FAIR_SHARE_PREFIX_V6
+    return str(ipaddress.ip_network(f"{address}/{prefix}", strict=False))
+
+class FairScheduler:
+    """Weighted fair queueing of extraction slots across client keys.
+
+    Each waiter gets a virtual finish tag of max(virtual_time, key's last tag)
+    + 1/weight, so a key with many queued requests only gets its share while
+    others are waiting. Lower priority classes are only served when every
+    higher class is empty; a full class queue sheds new work.
+    """
+
+    def __init__(self, slots: int = EXTRACTION_SLOTS, queue_limits: dict = QUEUE_LIMITS):
+        self.slots = slots
+        self.queue_limits = queue_limits
+        self.active = 0
+        self.queues = {priority: [] for priority in queue_limits}
+        self.waiting = defaultdict(int)
+        self.virtual_time = defaultdict(float)
+        self.last_finish = {priority: {} for priority in queue_limits}
+        self.key_waiting = {priority: defaultdict(int) for priority in queue_limits}
+        self.waits = {priority: deque(maxlen=WAIT_SAMPLES) for priority in queue_limits}
+        self.shed = defaultdict(int)
+        self._seq = 0
+
+    @asynccontextmanager
+    async def slot(self, key: str, priority: int = INTERACTIVE, weight: float = 1.0):
+        await self.acquire(key, priority, weight)
+        try:
+            yield
+        finally:
+            self.release()
+
+    async def run(self, key: str, priority: int, func, *args):
+        """Run a blocking call in a worker thread while holding a slot.
+
+        The slot is released when the thread finishes, not when the caller
+        stops waiting: cancelling the caller can't stop the thread, so the
+        slot has to keep counting it.
+        """
+        await self.acquire(key, priority)
+        work = asyncio.ensure_future(asyncio.to_thread(func, *args))
+        work.add_done_callback(self._work_done)
+        return await asyncio.shield(work)
+
+    def _work_done(self, work: asyncio.Future):
+        self.release()
+        if not work.cancelled():
+            # Retrieve the error even if the caller has gone away
+            work.exception()
+
+    async def acquire(self, key: str, priority: int = INTERACTIVE, weight: float = 1.0):
+        started = time.monotonic()
+        if self.active < self.slots and not any(self.waiting.values()):
+            self.active += 1
+            self.waits[priority].append(0.0)
+            return
+
+        if self.waiting[priority] >= self.queue_limits[priority]:
+            self.shed[priority] += 1
+            raise ValueError("SERVER_BUSY")
+
+        tag = max(self.virtual_time[priority], self.last_finish[priority].get(key, 0.0)) + 1.0 / weight
+        self.last_finish[priority][key] = tag
+        self.key_waiting[priority][key] += 1
+        self.waiting[priority] += 1
+        self._seq += 1
+        granted = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.queues[priority], (tag, self._seq, key, granted))
+
+        try:
+            await granted
+        except asyncio.CancelledError:
+            if granted.done() and not granted.cancelled():
+                # Slot was handed over just as we were cancelled: pass it on
+                self.release()
+            else:
+                # Entry stays in the heap and is skipped when popped
+                self._forget(priority, key)
+            raise
+        self.waits[priority].append(time.monotonic() - started)
+
+    def release(self):
+        self.active -= 1
+        for priority in sorted(self.queues):
+            queue = self.queues[priority]
+            while queue:
+                tag, _, key, granted = heapq.heappop(queue)
+                if granted.done():
+                    continue
+                self.virtual_time[priority] = tag
+                self._forget(priority, key)
+                self.active += 1
+                granted.set_result(None)
+                return
+
+    def _forget(self, priority: int, key: str):
+        self.waiting[priority] -= 1
+        self.key_waiting[priority][key] -= 1
+        if self.key_waiting[priority][key] <= 0:
+            # Idle keys restart from the current virtual time, so no need to remember them
+            del self.key_waiting[priority][key]
+            self.last_finish[priority].pop(key, None)
+
+    def get_stats(self) -> dict:
+        """Slot usage, queue depth, shed counts and queue-wait percentiles per class"""
+        classes = {}
+        for priority, samples in self.waits.items():
+            ordered = sorted(samples)
+            classes[priority] = {
+                'waiting': self.waiting[priority],
+                'shed': self.shed[priority],
+                'wait_p50_ms': round(ordered[len(ordered) // 2] * 1000, 1) if ordered else 0.0,
+                'wait_p95_ms': round(ordered[int(len(ordered) * 0.95)] * 1000, 1) if ordered else 0.0,
+                'wait_max_ms': round(ordered[-1] * 1000, 1) if ordered else 0.0
+            }
+        return {
+            'slots': self.slots,
+            'active': self.active,
+            'classes': {
+                'interactive': classes[INTERACTIVE],
+                'background': classes[BACKGROUND]
+            }
+        }
+
+extraction_scheduler = FairScheduler()
@@ -0,0 +1,81 @@
+import heapq
+
+TRENDING_CAPACITY = 1024
+TRENDING_DECAY_EVERY = 10000
+
+class HeavyHitters:
+    """Space-Saving sketch over canonical media IDs.
+
+    Keeps at most `capacity` counters no matter how many distinct IDs are
+    seen. A new ID replaces the smallest counter and inherits its count as
+    `error`, so `count - error` is a guaranteed lower bound on its frequency.
+    Counters are grouped into buckets by count (the stream-summary layout),
+    so every observation is O(1). Counts are halved every `decay_every`
+    observations so yesterday's hits fade out.
+    """
+
+    def __init__(self, capacity: int = TRENDING_CAPACITY, decay_every: int = TRENDING_DECAY_EVERY):
+        self.capacity = capacity
+        self.decay_every = decay_every
+        # id -> [count, error, last seen url]
+        self.counters = {}
+        # count -> ids with that count, oldest first
+        self.buckets = {}
+        self.min_count = 0
+        self.observed = 0
+
+    def observe(self, media_id: str, url: str):
+        entry = self.counters.get(media_id)
+        if entry:
+            self._unlink(media_id, entry[0])
+            entry[0] += 1
+            entry[2] = url
+        elif len(self.counters) < self.capacity:
+            entry = self.counters[media_id] = [1, 0, url]
+        else:
+            floor = self.min_count
+            victim = next(iter(self.buckets[floor]))
+            self._unlink(victim, floor)
+            del self.counters[victim]
+            entry = self.counters[media_id] = [floor + 1, floor, url]
+
+        self.buckets.setdefault(entry[0], {})[media_id] = None
+        if entry[0] == 1 or self.min_count not in self.buckets:
+            # Either a fresh counter, or the old minimum bucket just emptied
+            # and its members moved up by exactly one
+            self.min_count = entry[0] if entry[0] == 1 else min(entry[0], self.min_count + 1)
+
+        self.observed += 1
+        if self.observed % self.decay_every == 0:
+            self._decay()
+
+    def estimate(self, media_id: str) -> int:
+        entry = self.counters.get(media_id)
+        return entry[0] - entry[1] if entry else 0
+
+    def top(self, k: int) -> list:
+        ranked = heapq.nlargest(k, self.counters.items(), key=lambda item: item[1][0])
+        return [
+            {'id': media_id, 'count': count, 'error': error, 'url': url}
+            for media_id, (count, error, url) in ranked
+        ]
+
+    def _unlink(self, media_id: str, count: int):
+        bucket = self.buckets[count]
+        del bucket[media_id]
+        if not bucket:
+            del self.buckets[count]
+
+    def _decay(self):
+        self.buckets = {}
+        for media_id in list(self.counters):
+            entry = self.counters[media_id]
+            entry[0] //= 2
+            entry[1] //= 2
+            if entry[0] == 0:
+                del self.counters[media_id]
+            else:
+                self.buckets.setdefault(entry[0], {})[media_id] = None
+        self.min_count = min(self.buckets) if self.buckets else 0
+
+trending = HeavyHitters()
@@ -31,13 +31,16 @@ class URLValidator:
             r'channel/.*private',
         ]
 
-    def is_public_url(self, url: str) -> bool:
+    def is_public_url(self, url: str, allow_posts: bool = False) -> bool:
         parsed = urlparse(url)
         
         if not any(domain in parsed.netloc for domain in self.supported_domains):
             raise ValueError("Unsupported platform")
         
         for pattern in self.private_patterns:
+            # Instagram posts (/p/) are public when the account is; only expansion accepts them
+            if allow_posts and pattern == r'/p/':
+                continue
             if re.search(pattern, url, re.IGNORECASE):
                 raise ValueError("Private or login-required URLs not supported")
         